@@ -1,228 +1,589 @@
+import hashlib
+import io
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+
 import streamlit as st
+import numpy as np
 import pandas as pd
 import plotly.express as px
+import plotly.graph_objects as go
 import openai
 
 # --- CONFIG ---
 st.set_page_config(page_title="Franchise Test Dashboard", layout="wide", initial_sidebar_state="expanded")
 
-# Initialize chat history in session state
-if "messages" not in st.session_state:
-    st.session_state.messages = []
-
-# --- SIDEBAR ---
-st.sidebar.title("Upload Data 📊") # Updated title for clarity
-uploaded_file = st.sidebar.file_uploader("Upload Excel File", type=["xlsx"], help="Upload your 'june sample volume by location.xlsx' or similar Excel file.")
-
-if uploaded_file:
-    # Load data
+# Columns the dashboard works with; everything else in the workbook is discarded
+REQUIRED_COLUMNS = ['Franchisee', 'Sub Client', 'test name', 'Lab Partner']
+
+# Bump whenever load_df's output changes (columns, dtypes, the `_different` rule), so
+# Feather copies written by an older loader are never read back
+LOADER_VERSION = 2
+
+# Both load_df tiers expire parsed uploads after an hour; the Feather copies in the
+# shared temp dir are also capped in number, since they hold customer data
+CACHE_TTL_SECONDS = 60 * 60
+DISK_CACHE_MAX_FILES = 16
+
+# Chat history kept in session state, and how many of the latest messages render by default
+MAX_CHAT_MESSAGES = 50
+RECENT_CHAT_MESSAGES = 10
+
+# Label for the tests rolled up outside the top-K in the stacked chart and sunburst;
+# deliberately not a plausible test name, so a real test called "Other" stays separate
+OTHER_TESTS_LABEL = 'Other tests'
+
+# Display labels for the precomputed `_different` flag
+SUB_ACCOUNT_LABELS = {True: 'Sub Account Used', False: 'Direct Account'}
+
+
+class MissingColumnsError(ValueError):
+    """Raised when the uploaded workbook lacks one of REQUIRED_COLUMNS."""
+
+
+def category_counts(s: pd.Series, top: int | None = None) -> pd.Series:
+    """value_counts() for a categorical Series, via np.bincount over its integer codes.
+
+    With ``top``, only the ``top`` most frequent labels are decoded from the categories.
+    """
+    codes = s.cat.codes.to_numpy()
+    counts = np.bincount(codes[codes >= 0], minlength=len(s.cat.categories)) # -1 marks NaN
+    order = np.argsort(-counts, kind='stable')[:top] # Descending; ties keep category order
+    return pd.Series(counts[order], index=s.cat.categories[order], name='count')
+
+
+def prune_disk_cache(cache_dir: Path) -> None:
+    """Delete expired Feather copies, then all but the DISK_CACHE_MAX_FILES newest."""
+    now = time.time()
+    cached = []
+    for path in cache_dir.glob('franchise_*.feather'):
+        try:
+            cached.append((path.stat().st_mtime, path))
+        except OSError:
+            pass # Already removed by another session
+    cached.sort(reverse=True)
+    for i, (mtime, path) in enumerate(cached):
+        if i >= DISK_CACHE_MAX_FILES or now - mtime > CACHE_TTL_SECONDS:
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+
+@st.cache_data(show_spinner=False, max_entries=4, ttl=CACHE_TTL_SECONDS)
+def load_df(file_hash: str, _file_bytes: bytes) -> pd.DataFrame:
+    """Parse the uploaded workbook once per distinct file.
+
+    Two cache tiers, both keyed on ``file_hash``: st.cache_data keeps the frame in
+    memory (max_entries bounds it), and a Feather copy in the temp dir lets other
+    sessions or a restarted server skip the Excel parse entirely. Copies older than
+    CACHE_TTL_SECONDS are ignored, and each write prunes the directory.
+    """
+    cache_path = Path(tempfile.gettempdir()) / f"franchise_v{LOADER_VERSION}_{file_hash}.feather"
     try:
-        df = pd.read_excel(uploaded_file, engine="openpyxl")
-        # Ensure essential columns exist and handle NaNs for core analysis
-        required_columns = ['Franchisee', 'Sub Client', 'test name', 'Lab Partner']
-        if not all(col in df.columns for col in required_columns):
-            st.error(f"Error: Missing one or more required columns. Please ensure your file has columns: {', '.join(required_columns)}")
-            st.stop()
-        
-        df = df[required_columns].dropna(subset=['Franchisee', 'test name'])
-        
-        if df.empty:
-            st.warning("The uploaded file is empty or contains no valid data after filtering for Franchisee and Test Name.")
-            st.stop()
-
-    except Exception as e:
-        st.error(f"Error loading file: {e}. Please ensure it's a valid Excel file.")
-        st.stop()
-
-    # --- Display charts based on the entire uploaded dataset. ---
-    
-    # Assign the full DataFrame to filtered_df for chart generation
-    filtered_df = df.copy() 
-
-    # --- Dashboard Content ---
-    st.title("Franchise Performance Dashboard 📈")
-    st.markdown("Dive into your franchisee data to uncover patterns and insights.")
-
-    # Prepare temp DataFrame for sub-account analysis (used for both combined chart and pie chart)
-    temp = filtered_df.copy()
-    temp['Franchisee_norm'] = temp['Franchisee'].astype(str).str.lower().str.strip()
-    temp['Sub_Client_norm'] = temp['Sub Client'].astype(str).str.lower().str.strip()
-    temp['Sub_Account_Status'] = temp.apply(lambda row: 'Sub Account Used' if row['Franchisee_norm'] != row['Sub_Client_norm'] else 'Direct Account', axis=1)
-
+        if time.time() - cache_path.stat().st_mtime < CACHE_TTL_SECONDS:
+            return pd.read_feather(cache_path)
+    except OSError:
+        pass # No usable copy on disk (missing, or pruned meanwhile); parse the workbook
+
+    # Only convert the columns we keep, and read them as plain strings to skip
+    # per-cell type inference
+    read_kwargs = dict(usecols=lambda c: c in REQUIRED_COLUMNS, dtype=str)
+    try:
+        # calamine (Rust) parses xlsx several times faster than openpyxl
+        df = pd.read_excel(io.BytesIO(_file_bytes), engine="calamine", **read_kwargs)
+    except ImportError:
+        # python-calamine not installed: stream rows with openpyxl and skip formula evaluation
+        df = pd.read_excel(io.BytesIO(_file_bytes), engine="openpyxl", engine_kwargs={"read_only": True, "data_only": True}, **read_kwargs)
+    # Ensure essential columns exist and handle NaNs for core analysis
+    if not all(col in df.columns for col in REQUIRED_COLUMNS):
+        raise MissingColumnsError(', '.join(REQUIRED_COLUMNS))
+    # usecols already dropped every other column, so no projection copy is needed
+    df = df.dropna(subset=['Franchisee', 'test name'])
+    # All four columns are low-cardinality labels; as categories, value_counts and
+    # groupby run over integer codes instead of hashing Python strings
+    df = df.astype('category')
+    # Flag rows whose Sub Client differs from the Franchisee once per file, rather
+    # than re-normalising both string columns on every report. Only the distinct
+    # labels are lower/stripped; rows are then compared as integer ids into one
+    # shared vocabulary, so no per-row normalised strings are ever built. A missing
+    # Sub Client counts as different, as it always has.
+    franchisee_labels = df['Franchisee'].cat.categories.astype(str).str.lower().str.strip()
+    sub_client_labels = df['Sub Client'].cat.categories.astype(str).str.lower().str.strip()
+    vocab = franchisee_labels.append(sub_client_labels).unique()
+
+    def row_ids(column: str, labels: pd.Index) -> np.ndarray:
+        # Map each row's category code to its vocab id, -1 for a blank cell. Only valid
+        # codes index the lookup, which is empty when the whole column is blank.
+        codes = df[column].cat.codes.to_numpy()
+        ids = np.full(len(codes), -1)
+        valid = codes >= 0
+        ids[valid] = vocab.get_indexer(labels)[codes[valid]]
+        return ids
+
+    franchisee_ids = row_ids('Franchisee', franchisee_labels)
+    sub_client_ids = row_ids('Sub Client', sub_client_labels)
+    df['_different'] = (franchisee_ids != sub_client_ids) | (sub_client_ids < 0)
+
+    df = df.reset_index(drop=True) # Feather needs a default index
+    try:
+        # Write to a temp name and rename, so concurrent sessions never read a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent, suffix='.tmp')
+        os.close(fd)
+        df.to_feather(tmp_path)
+        os.replace(tmp_path, cache_path)
+        prune_disk_cache(cache_path.parent)
+    except OSError:
+        pass # The disk copy is best-effort; the in-memory cache still applies
+    return df
+
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def compute_report(file_hash: str, _df: pd.DataFrame) -> dict:
+    """Build every aggregate the charts need that doesn't depend on a widget.
+
+    Keyed on ``file_hash`` only (the leading underscore keeps Streamlit from
+    hashing the frame), so reruns for the same upload are a cache lookup.
+    """
     # --- Calculate Percentage of Samples from Sub Accounts with Different Names ---
     # This calculation is now done here to be merged into the main volume_by_franchisee DataFrame
-    sub_account_summary = temp.groupby('Franchisee')['Sub_Account_Status'].value_counts(normalize=True).unstack(fill_value=0)
-    if 'Sub Account Used' in sub_account_summary.columns:
-        sub_account_summary['% Sub Account Used'] = (sub_account_summary['Sub Account Used'] * 100).round(2)
-    else:
-        sub_account_summary['% Sub Account Used'] = 0.0 # If no sub accounts used at all
-    
+    # Share of sub-account rows is just the mean of the boolean flag per franchisee
+    sub_pct = (_df['_different'].groupby(_df['Franchisee'], observed=True).mean() * 100).round(2).rename('% Sub Account Used')
+
     # --- Franchisee Sample Volume (Enhanced with Top Test Info AND Sub-Account %) ---
-    st.header("Franchisee Sample Volume (with Top Test & Sub-Account %)") # Updated header
-    volume_by_franchisee = filtered_df['Franchisee'].value_counts().reset_index()
+    # category_counts is sorted descending, so reversing it gives the ascending order the
+    # Plotly bar chart wants without a second sort
+    volume_by_franchisee = category_counts(_df['Franchisee']).iloc[::-1].reset_index()
     volume_by_franchisee.columns = ['Franchisee', 'Sample Volume']
 
-    # Calculate top test and its volume for each franchisee
-    franchisee_test_volume = filtered_df.groupby(['Franchisee', 'test name']).size().reset_index(name='Test Volume')
-    # Find the test with the max volume for each franchisee
-    idx = franchisee_test_volume.groupby('Franchisee')['Test Volume'].idxmax()
-    top_test_per_franchisee = franchisee_test_volume.loc[idx].set_index('Franchisee')
-    top_test_per_franchisee.columns = ['Top Test Name', 'Top Test Volume'] # Rename columns for clarity
+    # Calculate top test and its volume for each franchisee; summing the sub-account flag in
+    # the same groupby also gives the sub-account/direct split the sunburst needs
+    franchisee_test_split = _df.groupby(['Franchisee', 'test name'], observed=True)['_different'].agg(['size', 'sum'])
+    franchisee_test_volume = franchisee_test_split['size'].rename('Test Volume').reset_index()
+    # Find the test with the max volume for each franchisee: one stable sort and keep each
+    # franchisee's first row (ties still go to the alphabetically first test, as idxmax did)
+    top_test_per_franchisee = (
+        franchisee_test_volume.sort_values('Test Volume', ascending=False, kind='stable')
+        .drop_duplicates('Franchisee')
+        .set_index('Franchisee')
+        .rename(columns={'test name': 'Top Test Name', 'Test Volume': 'Top Test Volume'}) # Rename columns for clarity
+    )
 
-    # Merge top test info into the main volume_by_franchisee DataFrame
-    volume_by_franchisee = volume_by_franchisee.set_index('Franchisee').join(top_test_per_franchisee).reset_index()
+    # Merge top test info and sub-account percentage into the main volume_by_franchisee
+    # DataFrame; join(on=...) looks Franchisee up in each index directly, so the frame
+    # never has to be re-indexed and reset between merges
+    volume_by_franchisee = volume_by_franchisee.join(top_test_per_franchisee, on='Franchisee').join(sub_pct, on='Franchisee')
 
-    # NEW: Merge sub-account percentage into the main volume_by_franchisee DataFrame
-    volume_by_franchisee = volume_by_franchisee.set_index('Franchisee').join(sub_account_summary[['% Sub Account Used']]).reset_index()
-    
     # Fill NaN for % Sub Account Used with 0.0 if a franchisee had no sub-account usage
     volume_by_franchisee['% Sub Account Used'] = volume_by_franchisee['% Sub Account Used'].fillna(0.0)
 
-    # Create a combined label for the Y-axis
-    volume_by_franchisee['Franchisee_Label'] = volume_by_franchisee.apply(
-        lambda row: f"{row['Franchisee']} ({row['% Sub Account Used']:.2f}% Sub-Acct)", axis=1
+    # Create a combined label for the Y-axis (column-wise string concat, no per-row apply)
+    volume_by_franchisee['Franchisee_Label'] = (
+        volume_by_franchisee['Franchisee'].astype(str) + ' ('
+        + volume_by_franchisee['% Sub Account Used'].map('{:.2f}'.format) + '% Sub-Acct)'
+    )
+
+    # int32 counts halve the binary payload Plotly ships to the browser
+    volume_by_franchisee = volume_by_franchisee.astype({'Sample Volume': 'int32', 'Top Test Volume': 'int32'})
+
+    # Get top N tests for each franchisee (top 5 for each): one stable sort and a groupby
+    # head instead of ranking every group; sort_index restores the original row order
+    top_tests_per_franchisee_chart = (
+        franchisee_test_volume.sort_values(['Franchisee', 'Test Volume'], ascending=[True, False], kind='stable')
+        .groupby('Franchisee', observed=True, sort=False)
+        .head(5)
+        .sort_index()
+    )
+    # Keep the stacked chart's trace count bounded: the 10 most common tests overall keep
+    # their own colour, every other test is summed into one OTHER_TESTS_LABEL segment per franchisee
+    test_counts = category_counts(_df['test name'], top=50) # The slider shows at most 50
+    chart_tests = top_tests_per_franchisee_chart['test name'].astype(str).where(
+        top_tests_per_franchisee_chart['test name'].isin(test_counts.index[:10]), OTHER_TESTS_LABEL
+    )
+    top_tests_per_franchisee_chart = (
+        top_tests_per_franchisee_chart.assign(**{'test name': chart_tests})
+        .groupby(['Franchisee', 'test name'], observed=True, sort=False)['Test Volume'].sum()
+        .astype('int32')
+        .reset_index()
+    )
+
+    # Aggregate by Franchisee, Sub_Account_Status, and test name from the split computed above,
+    # instead of a second groupby over every row with a third key
+    franchisee_sub_test_volume = (
+        pd.DataFrame({
+            SUB_ACCOUNT_LABELS[False]: franchisee_test_split['size'] - franchisee_test_split['sum'],
+            SUB_ACCOUNT_LABELS[True]: franchisee_test_split['sum'],
+        })
+        .rename_axis(columns='Sub_Account_Status')
+        .stack()
+        .rename('Sample Volume')
+        .reset_index()
+    )
+    franchisee_sub_test_volume = franchisee_sub_test_volume[franchisee_sub_test_volume['Sample Volume'] > 0]
+    # Bound the sunburst's leaf count the same way: tests outside the 20 most common
+    # overall are summed into one OTHER_TESTS_LABEL leaf under each franchisee and status
+    sunburst_tests = franchisee_sub_test_volume['test name'].astype(str).where(
+        franchisee_sub_test_volume['test name'].isin(test_counts.index[:20]), OTHER_TESTS_LABEL
+    )
+    franchisee_sub_test_volume = (
+        franchisee_sub_test_volume.assign(**{'test name': sunburst_tests})
+        .groupby(['Franchisee', 'Sub_Account_Status', 'test name'], observed=True, sort=False)['Sample Volume'].sum()
+        .reset_index()
     )
 
-    volume_by_franchisee = volume_by_franchisee.sort_values('Sample Volume', ascending=True) # Sort ascending for Plotly bar chart
-    
-    # Create the base bar chart for total sample volume
-    fig1 = px.bar(
-        volume_by_franchisee, 
-        y='Franchisee_Label', # Use the new combined label for the Y-axis
-        x='Sample Volume', 
+    return {
+        'volume_by_franchisee': volume_by_franchisee,
+        'test_counts': test_counts,
+        'lab_counts': category_counts(_df['Lab Partner']).iloc[::-1], # Ascending for the barh chart
+        'sub_account_counts': _df['_different'].value_counts().rename(SUB_ACCOUNT_LABELS),
+        'top_tests_per_franchisee_chart': top_tests_per_franchisee_chart,
+        'franchisee_sub_test_volume': franchisee_sub_test_volume,
+        'n_franchisees': len(volume_by_franchisee),
+        'row_count': len(_df),
+    }
+
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def build_figures(file_hash: str, _report: dict) -> dict:
+    """Build the charts that have no widgets, returned as Plotly JSON.
+
+    Keyed on ``file_hash`` like compute_report, so reruns skip plotly.express's
+    figure assembly (the sunburst especially); st.plotly_chart still validates the
+    cached spec into a Figure, which is the cheap part.
+    """
+    figures = {}
+
+    # The simple bar and pie charts are built as graph_objects traces straight from the
+    # cached Series, skipping plotly.express's DataFrame validation and reshaping
+    lab_counts = _report['lab_counts']
+    fig3 = go.Figure(go.Bar(
+        y=lab_counts.index.to_numpy(),
+        x=lab_counts.to_numpy(),
         orientation='h',
-        title='Franchisee Sample Volume and Sub-Account Usage', # Updated chart title
-        labels={'Franchisee_Label': 'Franchisee (Sub-Account %)', 'Sample Volume': 'Total Sample Volume'},
-        color_discrete_sequence=[px.colors.qualitative.Pastel[0]] # Base color for total volume
+        marker_color=px.colors.qualitative.Set2[0] # CORRECTED: Changed 'Light' to 'Set2'
+    ))
+    fig3.update_layout(
+        title='Lab Partner Usage',
+        xaxis_title='Sample Volume',
+        yaxis_title='Lab Partner',
+        height=max(400, 30 * len(lab_counts)),
+        showlegend=False
     )
-    
-    # Add a second trace for the 'Top Test Volume' as an overlay
-    fig1.add_trace(
-        px.bar(
-            volume_by_franchisee,
-            y='Franchisee_Label',
-            x='Top Test Volume',
+    figures['lab_partners'] = fig3.to_json()
+
+    sub_account_counts = _report['sub_account_counts']
+    fig4 = go.Figure(go.Pie(
+        values=sub_account_counts.to_numpy(),
+        labels=sub_account_counts.index.to_numpy(),
+        marker_colors=px.colors.qualitative.Pastel
+    ))
+    fig4.update_layout(title='Distribution of Sample Volume by Sub Account Status')
+    figures['sub_accounts'] = fig4.to_json()
+
+    top_tests_per_franchisee_chart = _report['top_tests_per_franchisee_chart']
+    figures['test_types'] = None
+    if not top_tests_per_franchisee_chart.empty:
+        fig5 = px.bar(
+            top_tests_per_franchisee_chart, # Use the new DataFrame for the chart
+            x='Test Volume',
+            y='Franchisee',
+            color='test name', # Changed back to 'test name' as it's the column in this dataframe
             orientation='h',
-            color_discrete_sequence=[px.colors.qualitative.Bold[0]] # Different color for top test volume
-        ).data[0] # Extract the data from the temporary bar chart
+            title='Franchisee Sample Volume by Test Type (Top 5 per Franchisee)',
+            labels={'Franchisee': 'Franchisee', 'Test Volume': 'Sample Volume', 'test name': 'Test Type'},
+            height=max(500, 50 * _report['n_franchisees']), # Adjust height based on unique franchisees in full data
+            color_discrete_sequence=px.colors.qualitative.Bold
+        )
+        fig5.update_layout(barmode='stack', yaxis={'categoryorder':'total ascending'})
+        figures['test_types'] = fig5.to_json()
+
+    franchisee_sub_test_volume = _report['franchisee_sub_test_volume']
+    figures['sunburst'] = None
+    if not franchisee_sub_test_volume.empty:
+        fig6 = px.sunburst(
+            franchisee_sub_test_volume,
+            path=['Franchisee', 'Sub_Account_Status', 'test name'],
+            values='Sample Volume',
+            title='Franchisee Sample Volume by Sub-Account Status and Test Type',
+            color='Sample Volume',
+            color_continuous_scale=px.colors.sequential.Viridis
+        )
+        fig6.update_layout(margin=dict(t=0, l=0, r=0, b=0))
+        figures['sunburst'] = fig6.to_json()
+
+    return figures
+
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def chat_context(file_hash: str, _report: dict) -> str:
+    """Summarise the upload for GPT once per file.
+
+    Built from the cached report rather than the rows, so the model reads the same
+    totals the charts show instead of re-deriving them, in far fewer tokens.
+    """
+    # volume_by_franchisee is sorted ascending for the bar chart; the largest come last
+    top_franchisees = _report['volume_by_franchisee'].iloc[::-1].head(50)
+    summary = {
+        'row_count': _report['row_count'],
+        'franchisee_count': _report['n_franchisees'],
+        'top_franchisees': top_franchisees[['Franchisee', 'Sample Volume', 'Top Test Name', 'Top Test Volume', '% Sub Account Used']].to_dict('split', index=False), # Column names once, not per row
+        'top_tests': _report['test_counts'].to_dict(),
+        'lab_partners': _report['lab_counts'].iloc[::-1].to_dict(),
+        'sub_account_split': _report['sub_account_counts'].to_dict(),
+    }
+    return json.dumps(summary, default=str)
+
+
+@st.cache_resource(show_spinner=False, on_release=lambda client: client.close())
+def get_openai_client(api_key: str) -> openai.OpenAI:
+    """Share one OpenAI client (and its HTTP connection pool) per API key.
+
+    The client is shared across sessions, so callers must not mutate it;
+    on_release closes its connections when the cache entry is evicted.
+    """
+    return openai.OpenAI(api_key=api_key)
+
+
+def stream_gpt(api_key: str, chat_data_context: str, question: str):
+    """Yield GPT's answer to a question about the uploaded data as it arrives."""
+    column_description = "Columns in the data: 'Franchisee' (name of the franchisee), 'Sub Client' (sub-account name, often matches franchisee or is different), 'test name' (type of test), 'Lab Partner' (lab processing the test)."
+
+    stream = get_openai_client(api_key).chat.completions.create(
+        model="gpt-4o-mini", # Much lower latency and cost than gpt-4 for this kind of lookup
+        messages=[
+            {"role": "system", "content": f"You are a helpful data analyst assistant specializing in lab testing datasets. Answer questions based on the provided data, which represents lab sample volume by franchisee. Here is a description of the columns: {column_description}\n\nHere is a JSON summary of the **currently uploaded** data (row and franchisee counts, the 50 largest franchisees with their top test and sub-account share, the 50 most common tests, sample volume per lab partner, and how many samples came through a sub-account versus directly):\n{chat_data_context}"},
+            {"role": "user", "content": f"User's question: {question}"}
+        ],
+        temperature=0.3,
+        max_tokens=1000,
+        stream=True
     )
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+# --- UI FRAGMENTS ---
+# Each fragment reruns on its own when one of its widgets changes, so moving a slider
+# or asking GPT doesn't rebuild and re-send every chart on the page.
+
+@st.fragment
+def render_franchisee_volume(report: dict):
+    # Cap the number of bars sent to the browser on very large uploads
+    n_franchisees = report['n_franchisees']
+    top_n_franchisees = st.slider("Number of Franchisees to Display:", 1, n_franchisees, min(n_franchisees, 50), key='top_n_franchisees_slider') if n_franchisees > 1 else n_franchisees
+    volume_by_franchisee = report['volume_by_franchisee'].tail(top_n_franchisees) # Sorted ascending, so the tail holds the largest
+
+    # Original Franchisee name, top test and sub-account % for both traces' tooltips
+    hover_data = volume_by_franchisee[['Franchisee', 'Top Test Name', 'Top Test Volume', '% Sub Account Used']].to_numpy()
+
+    fig1 = go.Figure([
+        # Base bar for total sample volume
+        go.Bar(
+            y=volume_by_franchisee['Franchisee_Label'], # Use the new combined label for the Y-axis
+            x=volume_by_franchisee['Sample Volume'],
+            orientation='h',
+            name='Sample Volume',
+            marker_color=px.colors.qualitative.Pastel[0], # Base color for total volume
+            customdata=hover_data,
+            # Enhance tooltip to show top test information and sub-account percentage
+            hovertemplate="<b>Franchisee</b>: %{customdata[0]}<br>" + # Use original Franchisee from customdata
+                          "<b>Total Sample Volume</b>: %{x}<br>" +
+                          "<b>Top Test</b>: %{customdata[1]}<br>" +
+                          "<b>Top Test Volume</b>: %{customdata[2]}<br>" +
+                          "<b>% Sub Account Used</b>: %{customdata[3]:.2f}%<extra></extra>"
+        ),
+        # Second trace for the 'Top Test Volume' as an overlay
+        go.Bar(
+            y=volume_by_franchisee['Franchisee_Label'],
+            x=volume_by_franchisee['Top Test Volume'],
+            orientation='h',
+            marker_color=px.colors.qualitative.Bold[0], # Different color for top test volume
+            customdata=hover_data,
+            hovertemplate="<b>Franchisee</b>: %{customdata[0]}<br>" +
+                          "<b>Top Test Volume</b>: %{x}<br>" +
+                          "<b>Top Test Name</b>: %{customdata[1]}<extra></extra>"
+        ),
+    ])
 
     fig1.update_layout(
+        title='Franchisee Sample Volume and Sub-Account Usage', # Updated chart title
+        xaxis_title='Total Sample Volume',
+        yaxis_title='Franchisee (Sub-Account %)',
         height=max(400, 30 * len(volume_by_franchisee)), 
         showlegend=False, # We'll manage legend manually if needed, for simplicity keep off
         barmode='overlay' # Overlay the bars
     )
-    
-    # Enhance tooltip to show top test information and sub-account percentage
-    fig1.update_traces(hovertemplate="<b>Franchisee</b>: %{customdata[0]}<br>" + # Use original Franchisee from customdata
-                                     "<b>Total Sample Volume</b>: %{x}<br>" +
-                                     "<b>Top Test</b>: %{customdata[1]}<br>" +
-                                     "<b>Top Test Volume</b>: %{customdata[2]}<br>" +
-                                     "<b>% Sub Account Used</b>: %{customdata[3]:.2f}%<extra></extra>",
-                       selector=dict(name='Sample Volume')) # Apply to the first trace (total volume)
-
-    # Add custom data for the second trace (Top Test Volume) for its tooltip
-    fig1.data[1].customdata = volume_by_franchisee[['Franchisee', 'Top Test Name', 'Top Test Volume', '% Sub Account Used']].values
-    fig1.data[1].hovertemplate = "<b>Franchisee</b>: %{customdata[0]}<br>" + \
-                                  "<b>Top Test Volume</b>: %{x}<br>" + \
-                                  "<b>Top Test Name</b>: %{customdata[1]}<extra></extra>"
 
+    st.plotly_chart(fig1, width="stretch")
 
-    st.plotly_chart(fig1, use_container_width=True)
 
-    # --- Most Common Tests (Top N configurable) ---
-    st.header("Most Common Tests")
-    # Using a default value for the slider since there are no filters to apply first
-    top_n_tests = st.slider("Number of Top Tests to Display:", 5, 50, 15, key='top_n_tests_slider') 
-    test_counts = filtered_df['test name'].value_counts().head(top_n_tests).sort_values(ascending=True)
+@st.cache_data(show_spinner=False, max_entries=64)
+def build_top_tests_figure(file_hash: str, top_n_tests: int, _test_counts: pd.Series) -> str:
+    """Plotly JSON for the Most Common Tests chart, cached per (file, slider value)."""
+    # value_counts is already sorted descending; reverse the slice for the ascending barh order
+    test_counts = _test_counts.head(top_n_tests).iloc[::-1]
 
-    fig2 = px.bar(
-        test_counts, 
-        y=test_counts.index, 
-        x=test_counts.values, 
+    fig2 = go.Figure(go.Bar(
+        y=test_counts.index.to_numpy(),
+        x=test_counts.to_numpy(),
         orientation='h',
+        marker_color=px.colors.qualitative.Safe[0]
+    ))
+    fig2.update_layout(
         title=f'Top {top_n_tests} Most Common Tests',
-        labels={'y': 'Test Name', 'x': 'Frequency'},
-        color_discrete_sequence=px.colors.qualitative.Safe
+        xaxis_title='Frequency',
+        yaxis_title='Test Name',
+        height=max(400, 30 * len(test_counts)),
+        showlegend=False
     )
-    fig2.update_layout(height=max(400, 30 * len(test_counts)), showlegend=False)
-    st.plotly_chart(fig2, use_container_width=True)
+    return fig2.to_json()
+
+
+@st.fragment
+def render_top_tests(file_hash: str, report: dict):
+    # Using a default value for the slider since there are no filters to apply first
+    top_n_tests = st.slider("Number of Top Tests to Display:", 5, 50, 15, key='top_n_tests_slider')
+    st.plotly_chart(json.loads(build_top_tests_figure(file_hash, top_n_tests, report['test_counts'])), width="stretch")
+
+
+@st.fragment
+def render_chat(openai_api_key: str, file_hash: str, report: dict):
+    # Display chat messages in the main area
+    # Using st.expander to make the chat history collapsible and manageable
+    with st.expander("Chat History", expanded=True): # Changed to st.expander
+        messages = st.session_state.messages
+        n_older = max(0, len(messages) - RECENT_CHAT_MESSAGES)
+        # Older messages are only rendered on request, so the markdown work per rerun
+        # stays bounded by RECENT_CHAT_MESSAGES (expanders can't nest here)
+        if n_older and st.toggle(f"Show older ({n_older} messages)", key="show_older_messages"):
+            visible = messages
+        else:
+            visible = messages[n_older:]
+        for message in visible:
+            # Use st.chat_message for better UI in the main area
+            with st.chat_message(message["role"]): # Changed to st.chat_message
+                st.markdown(message["content"])
+
+    # Use a form to ensure all inputs are cleared on submission
+    with st.form("chat_form"): # Changed to st.form
+        user_question = st.text_area("Ask a question about the UPLOADED data:", height=100, key="chat_input_form")
+        submit_button = st.form_submit_button("Ask GPT") # Changed to st.form_submit_button
+
+        if submit_button and user_question:
+            # Append user question to messages
+            st.session_state.messages.append({"role": "user", "content": user_question})
+
+            # Show spinner while thinking
+            with st.spinner("Thinking..."): # Changed to st.spinner
+                try:
+                    if report['row_count']:
+                        # Identical questions about the same data are answered from memory
+                        answer_key = (file_hash, user_question)
+                        gpt_response = st.session_state.gpt_answers.get(answer_key)
+                        if gpt_response is None:
+                            # Stream tokens into the page as they arrive instead of waiting for the full completion
+                            gpt_response = st.write_stream(stream_gpt(openai_api_key, chat_context(file_hash, report), user_question)).strip()
+                            if len(st.session_state.gpt_answers) >= 256: # Keep the memo bounded, dropping the oldest answer
+                                st.session_state.gpt_answers.pop(next(iter(st.session_state.gpt_answers)))
+                            st.session_state.gpt_answers[answer_key] = gpt_response
+                        st.session_state.messages.append({"role": "assistant", "content": gpt_response})
+                    else:
+                        st.session_state.messages.append({"role": "assistant", "content": "No data available to query the chatbot. Please upload a file first."})
+                except openai.AuthenticationError:
+                    st.session_state.messages.append({"role": "assistant", "content": "OpenAI API Key is invalid. Please check your key in Streamlit secrets."})
+                except openai.APIError as e:
+                    st.session_state.messages.append({"role": "assistant", "content": f"OpenAI API Error: {e}"})
+                except Exception as e:
+                    st.session_state.messages.append({"role": "assistant", "content": f"An unexpected error occurred with the chatbot: {e}"})
+
+            # Drop the oldest turns so session state doesn't grow with the conversation
+            st.session_state.messages = st.session_state.messages[-MAX_CHAT_MESSAGES:]
+
+            # MODIFICATION: Removed st.experimental_rerun() here.
+            # The form submission itself reruns this fragment, and the chat history will update.
+
+
+# Initialize chat history in session state
+if "messages" not in st.session_state:
+    st.session_state.messages = []
+# Answers already streamed this session, keyed on (file hash, question)
+if "gpt_answers" not in st.session_state:
+    st.session_state.gpt_answers = {}
+
+# --- SIDEBAR ---
+st.sidebar.title("Upload Data 📊") # Updated title for clarity
+uploaded_file = st.sidebar.file_uploader("Upload Excel File", type=["xlsx"], help="Upload your 'june sample volume by location.xlsx' or similar Excel file.")
+
+if uploaded_file:
+    # Load data only when a new file is uploaded; later reruns reuse the frame kept in
+    # session state instead of rehashing the upload bytes for the cache lookup
+    if st.session_state.get('file_id') != uploaded_file.file_id:
+        try:
+            file_bytes = uploaded_file.getvalue()
+            file_hash = hashlib.blake2b(file_bytes, digest_size=16).hexdigest()
+            st.session_state.df = load_df(file_hash, file_bytes)
+        except MissingColumnsError:
+            st.error(f"Error: Missing one or more required columns. Please ensure your file has columns: {', '.join(REQUIRED_COLUMNS)}")
+            st.stop()
+        except Exception as e:
+            st.error(f"Error loading file: {e}. Please ensure it's a valid Excel file.")
+            st.stop()
+        st.session_state.file_hash = file_hash
+        st.session_state.file_id = uploaded_file.file_id
+
+    df = st.session_state.df
+    file_hash = st.session_state.file_hash
+
+    if df.empty:
+        st.warning("The uploaded file is empty or contains no valid data after filtering for Franchisee and Test Name.")
+        st.stop()
+
+    # --- Display charts based on the entire uploaded dataset. ---
+
+    # Assign the full DataFrame to filtered_df for chart generation; nothing downstream
+    # mutates it, so the cached frame is shared rather than copied on every rerun
+    filtered_df = df
+    # Every slider-independent aggregate and figure, computed once per uploaded file
+    report = compute_report(file_hash, filtered_df)
+    figures = build_figures(file_hash, report)
+
+    # --- Dashboard Content ---
+    st.title("Franchise Performance Dashboard 📈")
+    st.markdown("Dive into your franchisee data to uncover patterns and insights.")
+
+    # --- Franchisee Sample Volume (Enhanced with Top Test Info AND Sub-Account %) ---
+    st.header("Franchisee Sample Volume (with Top Test & Sub-Account %)") # Updated header
+    render_franchisee_volume(report)
+
+    # --- Most Common Tests (Top N configurable) ---
+    st.header("Most Common Tests")
+    render_top_tests(file_hash, report)
 
     # --- Lab Partner Usage ---
     st.header("Lab Partner Usage")
-    lab_counts = filtered_df['Lab Partner'].value_counts().sort_values(ascending=True)
-
-    fig3 = px.bar(
-        lab_counts, 
-        y=lab_counts.index, 
-        x=lab_counts.values, 
-        orientation='h',
-        title='Lab Partner Usage',
-        labels={'y': 'Lab Partner', 'x': 'Sample Volume'},
-        color_discrete_sequence=px.colors.qualitative.Set2 # CORRECTED: Changed 'Light' to 'Set2'
-    )
-    fig3.update_layout(height=max(400, 30 * len(lab_counts)), showlegend=False)
-    st.plotly_chart(fig3, use_container_width=True)
+    st.plotly_chart(json.loads(figures['lab_partners']), width="stretch")
 
     # --- Sub Account vs Franchisee Analysis (Pie Chart remains for overall distribution) ---
     st.header("Overall Sub Account vs Franchisee Relationship") # Updated header for clarity
-    # temp DataFrame is already prepared above
-    sub_account_counts = temp['Sub_Account_Status'].value_counts()
-
-    fig4 = px.pie(
-        values=sub_account_counts.values, 
-        names=sub_account_counts.index, 
-        title='Distribution of Sample Volume by Sub Account Status',
-        color_discrete_sequence=px.colors.qualitative.Pastel
-    )
-    st.plotly_chart(fig4, use_container_width=True)
+    st.plotly_chart(json.loads(figures['sub_accounts']), width="stretch")
 
     # --- Franchisee Sample Volume by Test Type (Top N for all franchisees) ---
     st.header("Franchisee Sample Volume by Top Test Types 🧪")
     st.markdown("Explore which test types contribute most to each franchisee's volume.")
-    
-    # Aggregate data for top tests per franchisee
-    # franchisee_test_volume is already calculated above for the top test feature
-    
-    # Get top N tests for each franchisee (top 5 for each)
-    top_tests_per_franchisee_chart = franchisee_test_volume.loc[franchisee_test_volume.groupby('Franchisee')['Test Volume'].rank(method='first', ascending=False) <= 5] 
-
-    if not top_tests_per_franchisee_chart.empty:
-        fig5 = px.bar(
-            top_tests_per_franchisee_chart, # Use the new DataFrame for the chart
-            x='Test Volume', 
-            y='Franchisee',
-            color='test name', # Changed back to 'test name' as it's the column in this dataframe
-            orientation='h',
-            title='Franchisee Sample Volume by Test Type (Top 5 per Franchisee)',
-            labels={'Franchisee': 'Franchisee', 'Test Volume': 'Sample Volume', 'test name': 'Test Type'},
-            height=max(500, 50 * len(filtered_df['Franchisee'].unique())), # Adjust height based on unique franchisees in full data
-            color_discrete_sequence=px.colors.qualitative.Bold
-        )
-        fig5.update_layout(barmode='stack', yaxis={'categoryorder':'total ascending'})
-        st.plotly_chart(fig5, use_container_width=True)
+    if figures['test_types'] is not None:
+        st.plotly_chart(json.loads(figures['test_types']), width="stretch")
     else:
         st.info("No data to display for Franchisee Performance: Sub-Accounts & Test Types.")
 
     # --- NEW: Franchisee Sample Volume by Sub Account Status and Test Type ---
     st.header("Franchisee Performance: Sub-Accounts & Test Types 🎯")
     st.markdown("Analyze how sample volume is distributed across sub-account usage and specific test types for each franchisee.")
-    
-    # temp is already created above and contains the 'Sub_Account_Status' column
-    # Aggregate by Franchisee, Sub_Account_Status, and test name
-    franchisee_sub_test_volume = temp.groupby(['Franchisee', 'Sub_Account_Status', 'test name']).size().reset_index(name='Sample Volume')
-
-    if not franchisee_sub_test_volume.empty:
-        fig6 = px.sunburst(
-            franchisee_sub_test_volume,
-            path=['Franchisee', 'Sub_Account_Status', 'test name'],
-            values='Sample Volume',
-            title='Franchisee Sample Volume by Sub-Account Status and Test Type',
-            color='Sample Volume',
-            color_continuous_scale=px.colors.sequential.Viridis
-        )
-        fig6.update_layout(margin=dict(t=0, l=0, r=0, b=0))
-        st.plotly_chart(fig6, use_container_width=True)
+    if figures['sunburst'] is not None:
+        st.plotly_chart(json.loads(figures['sunburst']), width="stretch")
     else:
         st.info("No data to display for Franchisee Performance: Sub-Accounts & Test Types.")
 
@@ -238,55 +599,7 @@ openai_api_key = st.secrets["OPENAI_API_KEY"] if "OPENAI_API_KEY" in st.secrets
 
 if openai_api_key: # Check if key is available from secrets
     if uploaded_file and 'filtered_df' in locals(): # filtered_df now holds the full df
-        # Display chat messages in the main area
-        # Using st.expander to make the chat history collapsible and manageable
-        with st.expander("Chat History", expanded=True): # Changed to st.expander
-            for message in st.session_state.messages:
-                # Use st.chat_message for better UI in the main area
-                with st.chat_message(message["role"]): # Changed to st.chat_message
-                    st.markdown(message["content"])
-
-        # Use a form to ensure all inputs are cleared on submission
-        with st.form("chat_form"): # Changed to st.form
-            user_question = st.text_area("Ask a question about the UPLOADED data:", height=100, key="chat_input_form")
-            submit_button = st.form_submit_button("Ask GPT") # Changed to st.form_submit_button
-
-            if submit_button and user_question:
-                # Append user question to messages
-                st.session_state.messages.append({"role": "user", "content": user_question})
-                
-                # Show spinner while thinking
-                with st.spinner("Thinking..."): # Changed to st.spinner
-                    try:
-                        openai.api_key = openai_api_key 
-                        
-                        if not filtered_df.empty:
-                            chat_data_context = filtered_df.head(500).to_csv(index=False)
-                            column_description = "Columns in the data: 'Franchisee' (name of the franchisee), 'Sub Client' (sub-account name, often matches franchisee or is different), 'test name' (type of test), 'Lab Partner' (lab processing the test)."
-
-                            response = openai.ChatCompletion.create(
-                                model="gpt-4", 
-                                messages=[
-                                    {"role": "system", "content": f"You are a helpful data analyst assistant specializing in lab testing datasets. Answer questions based on the provided data, which represents lab sample volume by franchisee. Here is a description of the columns: {column_description}"},
-                                    {"role": "user", "content": f"Here is a sample of the **currently uploaded** data:\n{chat_data_context}\n\nUser's question: {user_question}"}
-                                ],
-                                temperature=0.3,
-                                max_tokens=1000 
-                            )
-                            gpt_response = response.choices[0].message.content.strip()
-                            st.session_state.messages.append({"role": "assistant", "content": gpt_response})
-                        else:
-                            st.session_state.messages.append({"role": "assistant", "content": "No data available to query the chatbot. Please upload a file first."})
-                    except openai.error.AuthenticationError:
-                        st.session_state.messages.append({"role": "assistant", "content": "OpenAI API Key is invalid. Please check your key in Streamlit secrets."})
-                    except openai.error.APIError as e:
-                        st.session_state.messages.append({"role": "assistant", "content": f"OpenAI API Error: {e}"})
-                    except Exception as e:
-                        st.session_state.messages.append({"role": "assistant", "content": f"An unexpected error occurred with the chatbot: {e}"})
-                
-                # MODIFICATION: Removed st.experimental_rerun() here.
-                # The form submission itself triggers a rerun, and the chat history will update.
-
+        render_chat(openai_api_key, file_hash, report)
     elif not uploaded_file:
         st.info("Please upload a file before asking questions to the chatbot.") # Changed to st.info
     else: